@@ -24,10 +24,8 @@ import json
 import shutil
 import socket
 import struct
-import subprocess
 import traceback
-from time import sleep
-from threading import Thread
+from threading import Thread, Event
 import numpy as np
 from ldpc_encoder import *
 from radio_wrappers import *
@@ -97,6 +95,10 @@ class PacketTX(object):
 
         self.idle_message = self.frame_packet(self.idle_sequence,fec=fec)
 
+        # Set whenever the SSDV queue has been emptied, so callers can wait on it rather than polling.
+        self.queue_empty_event = Event()
+        self.queue_empty_event.set()
+
         if log_file != None:
             self.log_file = open(log_file,'a')
             print(f"Opened log file {log_file}")
@@ -159,6 +161,8 @@ class PacketTX(object):
                 self.radio.transmit_packet(packet)
             elif self.ssdv_queue.qsize()>0:
                 packet = self.ssdv_queue.get_nowait()
+                if self.ssdv_queue.qsize() == 0:
+                    self.queue_empty_event.set()
                 self.radio.transmit_packet(packet)
             else:
                 self.radio.transmit_packet(self.idle_message)
@@ -176,21 +180,23 @@ class PacketTX(object):
 
     # Deprecated function
     def tx_packet(self,packet,blocking = False):
+        self.queue_empty_event.clear()
         self.ssdv_queue.put(self.frame_packet(packet, self.fec))
 
         if blocking:
             while not self.ssdv_queue.empty():
-                sleep(0.01)
+                self.queue_empty_event.wait(timeout=0.1)
 
 
     # Deprecated function.
     def wait(self):
         while (not self.ssdv_queue.empty()) and self.transmit_active:
-            sleep(0.01)
+            self.queue_empty_event.wait(timeout=0.1)
 
     # New packet queueing and queue querying functions (say that 3 times fast)
 
     def queue_image_packet(self,packet):
+        self.queue_empty_event.clear()
         self.ssdv_queue.put(self.frame_packet(packet, self.fec))
 
 
@@ -198,17 +204,22 @@ class PacketTX(object):
         """ Read in <filename> and transmit it, 256 bytes at a time.
             Intended for transmitting SSDV images.
         """
-        file_size = os.path.getsize(filename)
         try:
-            f = open(filename,'rb')
-            for x in range(file_size//256):
-                data = f.read(256)
-                self.queue_image_packet(data)
-            f.close()
-            return True
+            with open(filename,'rb') as f:
+                data = f.read()
         except:
             return False
 
+        return self.queue_image_bytes(data)
+
+    def queue_image_bytes(self, data):
+        """ Transmit <data>, 256 bytes at a time.
+            Intended for transmitting SSDV images which are already held in memory.
+        """
+        for x in range(len(data)//256):
+            self.queue_image_packet(data[x*256:(x+1)*256])
+        return True
+
     def image_queue_empty(self):
         return self.ssdv_queue.qsize() == 0
 
@@ -454,9 +465,9 @@ class PacketTX(object):
     def get_cpu_temperature(self):
         """ Grab the temperature of the RPi CPU """
         try:
-            data = subprocess.check_output("/usr/bin/vcgencmd measure_temp", shell=True)
-            temp = data.decode().split('=')[1].split('\'')[0]
-            return float(temp)
+            with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
+                temp = int(f.read().strip())/1000.0
+            return temp
         except Exception as e:
             print("Error reading temperature - %s" % str(e))
             return -999.0
@@ -464,8 +475,8 @@ class PacketTX(object):
     def get_cpu_speed(self):
         """ Get the current CPU Frequency """
         try:
-            data = subprocess.check_output("cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", shell=True)
-            freq = int(data.decode().strip())/1000
+            with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", "r") as f:
+                freq = int(f.read().strip())/1000
             return freq
         except Exception as e:
             print("Error reading CPU Freq - %s" % str(e))
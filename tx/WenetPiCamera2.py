@@ -10,17 +10,20 @@
 #		https://github.com/raspberrypi/picamera2
 #		https://datasheets.raspberrypi.com/camera/picamera2-manual.pdf
 
-import glob
+import io
 import os
-import datetime
+import piexif
+import simplejpeg
 import subprocess
 import time
 import traceback
 
+from PIL import Image
 from picamera2 import Picamera2
 from libcamera import controls, Transform
 from time import sleep
-from threading import Thread
+from threading import Thread, Event
+from queue import Queue, Empty, Full
 
 
 
@@ -54,6 +57,7 @@ class WenetPiCamera2(object):
                 whitebalance = 'auto',
                 lens_position = -1,
                 temp_filename_prefix = 'picam_temp',
+                save_full_resolution = True,
                 debug_ptr = None,
                 init_retries = 10
                 ):
@@ -69,6 +73,9 @@ class WenetPiCamera2(object):
 
             num_images: Number of images to capture in sequence when the 'capture' function is called.
                         The 'best' (largest filesize) image is selected and saved.
+                        This only applies in continuous autofocus mode, to guard against out-of-focus images,
+                        and only if the camera has not reported that exposure and focus have settled.
+                        Otherwise only a single image is captured.
             image_delay: Delay time (seconds) between each captured image.
 
             vertical_flip: Flip captured images vertically.
@@ -80,6 +87,13 @@ class WenetPiCamera2(object):
                    Set to -1 to use continuous autofocus mode.
 
             temp_filename_prefix: prefix used for temporary files.
+                        If left as the default, temporary files are placed in /dev/shm (RAM) when available,
+                        to avoid writing them to the SD card.
+
+            save_full_resolution: If True (default), images are captured and saved at the camera's native resolution,
+                        and a transmit resolution copy is produced for transmission.
+                        If False, images are captured directly at the transmit resolution, which avoids
+                        encoding a full resolution image, but means only transmit resolution images are saved.
 
             debug_ptr:	'pointer' to a function which can handle debug messages.
                         This function needs to be able to accept a string.
@@ -88,10 +102,19 @@ class WenetPiCamera2(object):
         """
 
         self.debug_ptr = debug_ptr
+
+        # Keep temporary files on a tmpfs if we can, as they are only needed briefly.
+        if temp_filename_prefix == 'picam_temp' and os.path.isdir('/dev/shm'):
+            temp_filename_prefix = os.path.join('/dev/shm', temp_filename_prefix)
         self.temp_filename_prefix = temp_filename_prefix
+        # Temporary files which have been created, but not yet cleaned up.
+        self.temp_files = []
+        self.save_full_resolution = save_full_resolution
         self.num_images = num_images
         self.image_delay = image_delay
         self.callsign = callsign
+        # The parts of the ssdv command line which don't change between images.
+        self.ssdv_command_base = ["ssdv", "-e", "-n", "-c", self.callsign]
         self.tx_resolution_init = tx_resolution
         self.horizontal_flip = horizontal_flip
         self.vertical_flip = vertical_flip
@@ -103,6 +126,13 @@ class WenetPiCamera2(object):
         else:
             self.whitebalance = self.wb_lookup['auto']
 
+        # Debug messages are passed on to debug_ptr from a background thread, so that a slow
+        # downlink doesn't hold up image capture. If the queue fills up, the oldest messages are dropped.
+        self.debug_queue = Queue(maxsize=64)
+        if self.debug_ptr != None:
+            self.debug_thread = Thread(target=self.debug_worker, daemon=True)
+            self.debug_thread.start()
+
 
         # If we startup too early, the camera is sometimes not available to us.
         # Try and initialise for a while with breaks in between until we can talk to it...
@@ -131,23 +161,55 @@ class WenetPiCamera2(object):
 
         self.camera_properties = self.cam.camera_properties
 
-        self.debug_ptr("Camera Native Resolution: " + str(self.camera_properties['PixelArraySize']))
+        # Check if this camera has a controllable lens (e.g. Pi Camera 3) once, as camera_controls is rebuilt on each access.
+        self.has_lens_position = 'LensPosition' in self.cam.camera_controls
+        self.autofocus_mode = self.has_lens_position and self.lens_position<0.0
+
+        self.debug_message("Camera Native Resolution: " + str(self.camera_properties['PixelArraySize']))
 
         # If the user has explicitly specified the transmit image resolution, use it.
         if type(self.tx_resolution_init) == tuple:
-            self.tx_resolution = self.tx_resolution_init
-            self.debug_ptr(f"Transmit Resolution set to {str(self.tx_resolution)}")
+            self.tx_resolution = tuple(self.tx_resolution_init)
+            self.debug_message(f"Transmit Resolution set to {str(self.tx_resolution)}")
         # Otherwise, has the user provided a floating point scaling factor?
         elif type(self.tx_resolution_init) == float:
             res_x = 16*int(self.camera_properties['PixelArraySize'][0]*self.tx_resolution_init/16)
             res_y = 16*int(self.camera_properties['PixelArraySize'][1]*self.tx_resolution_init/16)
             self.tx_resolution = (res_x, res_y)
-            self.debug_ptr(f"Transmit Resolution set to {str(self.tx_resolution)}, scaled {self.tx_resolution_init} from native.")
+            self.debug_message(f"Transmit Resolution set to {str(self.tx_resolution)}, scaled {self.tx_resolution_init} from native.")
+
+        # If the transmit resolution is smaller than the native resolution, get the ISP to produce
+        # a second 'lores' stream at the transmit resolution, so we don't have to resize the image ourselves.
+        # The lores stream cannot be larger than the main stream, in which case we fall back to resizing.
+        # These are all worked out once here, so the per-image code paths don't need to.
+        _native_res = tuple(self.camera_properties['PixelArraySize'])
+        self.lores_enabled = self.save_full_resolution \
+            and (self.tx_resolution[0] <= _native_res[0]) and (self.tx_resolution[1] <= _native_res[1]) \
+            and (self.tx_resolution != _native_res)
+        # We only need to resize the captured image if we aren't capturing at the transmit resolution already.
+        self.resize_required = self.save_full_resolution and (not self.lores_enabled) \
+            and (self.tx_resolution != _native_res)
 
         # Configure camera, including flip settings.
-        capture_config = self.cam.create_still_configuration(
-            transform=Transform(hflip=self.horizontal_flip, vflip=self.vertical_flip)
-        )
+        # Note that Picamera2's BGR888 format is stored as R,G,B byte order in memory,
+        # which is what we need for JPEG encoding.
+        if not self.save_full_resolution:
+            # Capture straight at the transmit resolution, with the ISP doing the scaling.
+            capture_config = self.cam.create_still_configuration(
+                main={"size": self.tx_resolution, "format": "BGR888"},
+                transform=Transform(hflip=self.horizontal_flip, vflip=self.vertical_flip)
+            )
+        elif self.lores_enabled:
+            capture_config = self.cam.create_still_configuration(
+                main={"size": _native_res, "format": "BGR888"},
+                lores={"size": self.tx_resolution, "format": "YUV420"},
+                transform=Transform(hflip=self.horizontal_flip, vflip=self.vertical_flip)
+            )
+        else:
+            capture_config = self.cam.create_still_configuration(
+                main={"format": "BGR888"},
+                transform=Transform(hflip=self.horizontal_flip, vflip=self.vertical_flip)
+            )
         self.cam.configure(capture_config)
 
         # Set other settings, White Balance, exposure metering, etc.
@@ -159,21 +221,20 @@ class WenetPiCamera2(object):
             )
 
         # Set Pi Camera 3 lens position
-        if 'LensPosition' in self.cam.camera_controls:
+        if self.has_lens_position:
             if self.lens_position>=0.0:
-                self.debug_ptr("Configured lens position to " + str(self.lens_position))
+                self.debug_message("Configured lens position to " + str(self.lens_position))
                 self.cam.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": self.lens_position})
             else:
                 self.cam.set_controls({"AfMode": controls.AfModeEnum.Continuous})
 
-        # In autofocus mode, we need to start the camera now, so it can start figuring out its focus.
-        if 'LensPosition' in self.cam.camera_controls and self.lens_position<0.0:
-            self.debug_message("Enabling camera for image capture")
-            self.cam.start()
-
-        # If we are not in autofocus mode, we start the camera only when we need it.
-        # This may help deal with crashes after the camera is running for a long time, and also
-        # may help decrease CPU usage a little.
+        # Start the camera now, and leave it running between captures.
+        # Stopping and starting the camera for each capture means re-allocating buffers and
+        # tearing down the ISP pipeline every time. In autofocus mode, this also gives the camera
+        # time to start figuring out its focus.
+        # If the camera fails at some point, it is re-initialised by the capture loop.
+        self.debug_message("Enabling camera for image capture")
+        self.cam.start()
 
     def debug_message(self, message):
         """ Write a debug message.
@@ -184,10 +245,27 @@ class WenetPiCamera2(object):
         """
         message = "PiCam Debug: " + message
         if self.debug_ptr != None:
-            self.debug_ptr(message)
+            try:
+                self.debug_queue.put_nowait(message)
+            except Full:
+                # Drop the oldest message to make room.
+                try:
+                    self.debug_queue.get_nowait()
+                    self.debug_queue.put_nowait(message)
+                except (Empty, Full):
+                    pass
         else:
             print(message)
 
+    def debug_worker(self):
+        """ Pass queued debug messages on to debug_ptr. """
+        while True:
+            message = self.debug_queue.get()
+            try:
+                self.debug_ptr(message)
+            except:
+                traceback.print_exc()
+
     def close(self):
         try:
             self.cam.stop()
@@ -198,53 +276,156 @@ class WenetPiCamera2(object):
         except:
             self.debug_message("Closing camera object failed.")
 
-    def capture(self, filename='picam.jpg', quality=90):
-        """ Capture an image using the PiCam
-            
+    def wait_for_convergence(self, timeout=2.0):
+        """ Wait until the camera reports that auto-exposure and auto-white-balance have settled,
+            and that focus has been achieved if we are in continuous autofocus mode.
+            This replaces a fixed delay before capture, which was mostly wasted time on a stable scene.
+
             Keyword Arguments:
-            filename:	destination filename.
+            timeout: Maximum time (seconds) to wait.
+
+            Returns True if the camera settled within the timeout, otherwise False.
         """
+        _start = time.monotonic()
+        while (time.monotonic() - _start) < timeout:
+            # This blocks until the next frame arrives.
+            _metadata = self.cam.capture_metadata()
 
-        # Ensure JPG quality is set as required.
-        self.cam.options['quality'] = quality
+            if _metadata.get('AeLocked') and ('ColourGains' in _metadata):
+                if (not self.autofocus_mode) or (_metadata.get('AfState') == controls.AfStateEnum.Focused):
+                    return True
 
-        # Set other settings, White Balance, exposure metering, etc.
-        # TODO - Maybe expose some of these settings?
-        self.cam.set_controls(
-            {'AwbMode': self.whitebalance,
-            'AeMeteringMode': controls.AeMeteringModeEnum.Matrix,
-            'NoiseReductionMode': controls.draft.NoiseReductionModeEnum.Off}
-            )
+        return False
 
-        # Set Pi Camera 3 lens position, or ensure we are in continuous autofocus mode.
-        if 'LensPosition' in self.cam.camera_controls:
-            if self.lens_position>=0.0:
-                self.debug_ptr("Configured lens position to " + str(self.lens_position))
-                self.cam.set_controls({"AfMode": controls.AfModeEnum.Manual, "LensPosition": self.lens_position})
-            else:
-                self.cam.set_controls({"AfMode": controls.AfModeEnum.Continuous})
+    def remove_temp_file(self, filename):
+        """ Remove a temporary file, and stop tracking it. """
+        try:
+            os.unlink(filename)
+        except FileNotFoundError:
+            pass
 
+        try:
+            self.temp_files.remove(filename)
+        except ValueError:
+            pass
 
-        # If we're not using autofocus, then camera would not have been started yet.
-        # Start it now.
-        if 'LensPosition' not in self.cam.camera_controls or self.lens_position>=0.0:
-            try:
-                self.debug_message("Enabling camera for image capture")
-                self.cam.start()
-            except Exception as e:
-                self.debug_message("Could not enable camera! - " + str(e))
-                sleep(1)
-                return False
+    def cleanup_temp_files(self):
+        """ Remove any temporary JPEG files matching <temp_filename_prefix>_*.jpg.
+            Uses a single directory scan, rather than a glob.
+        """
+        (_dir, _prefix) = os.path.split(self.temp_filename_prefix)
+
+        # Without a filename prefix we can't tell our files apart from anything else in the directory
+        # (e.g. saved images), so don't touch anything.
+        if not _prefix:
+            return
+
+        try:
+            with os.scandir(_dir if _dir else '.') as _entries:
+                for _entry in _entries:
+                    if _entry.name.startswith(_prefix + "_") and _entry.name.endswith('.jpg'):
+                        try:
+                            os.unlink(_entry.path)
+                        except FileNotFoundError:
+                            pass
+        except OSError as e:
+            self.debug_message("Could not clean up temporary files - %s" % str(e))
+
+    def yuv420_to_jpeg(self, array, size, quality=90):
+        """ JPEG encode a YUV420 image array, as produced by the lores stream.
+
+            Keyword Arguments:
+            array:  YUV420 image array, of shape (height*3/2, stride).
+            size:   (width, height) of the image.
+            quality: JPEG quality.
+        """
+        (_width, _height) = size
+        _stride = array.shape[1]
 
-        sleep(3)
+        # Split out the Y, U and V planes. The U and V planes are stored with half the stride of the Y plane.
+        _y = array[:_height, :_width]
+        _reshaped = array.reshape((_height*3, _stride//2))
+        _u = _reshaped[_height*2:_height*2 + _height//2, :_width//2]
+        _v = _reshaped[_height*2 + _height//2:, :_width//2]
+
+        return simplejpeg.encode_jpeg_yuv_planes(_y, _u, _v, quality=quality, fastdct=True)
+
+    def add_exif(self, jpeg, metadata):
+        """ Add camera EXIF data to a JPEG image, as Picamera2 does when saving a JPEG.
+
+            Keyword Arguments:
+            jpeg:   JPEG image data (bytes).
+            metadata: Metadata of the frame the image was captured from.
+
+            Returns the JPEG image data with the EXIF data added.
+        """
+        _zeroth_ifd = {
+            piexif.ImageIFD.Make: "Raspberry Pi",
+            piexif.ImageIFD.Model: str(self.camera_properties.get('Model', '')),
+            piexif.ImageIFD.Software: "Picamera2"
+        }
+        _exif_ifd = {}
+        if 'ExposureTime' in metadata:
+            _exif_ifd[piexif.ExifIFD.ExposureTime] = (metadata['ExposureTime'], 1000000)
+        if 'AnalogueGain' in metadata:
+            _exif_ifd[piexif.ExifIFD.ISOSpeedRatings] = int(metadata['AnalogueGain'] * metadata.get('DigitalGain', 1.0) * 100)
+
+        _output = io.BytesIO()
+        piexif.insert(piexif.dump({"0th": _zeroth_ifd, "Exif": _exif_ifd}), jpeg, _output)
+        return _output.getvalue()
+
+    def capture(self, filename='picam.jpg', quality=90, tx_filename=None):
+        """ Capture an image using the PiCam
+            
+            Keyword Arguments:
+            filename:	destination filename.
+            quality:    JPEG quality.
+            tx_filename: If provided, and the camera is producing a transmit resolution (lores) stream,
+                        the transmit resolution version of the best image is also saved to this filename.
+        """
+
+        # Note that White Balance, exposure metering, lens position etc. have already been set in init_camera(),
+        # and the camera is already running.
+
+        # Wait for the exposure / white balance (and focus, if enabled) to settle.
+        _converged = self.wait_for_convergence()
+        if not _converged:
+            self.debug_message("Timed out waiting for exposure to settle, capturing anyway.")
+
+        # Capturing multiple images only helps if focus may vary between them.
+        # With a fixed lens, all images will be near-identical, and if the camera has told us
+        # it is focused and exposure has settled, there's nothing to gain either. So just capture one.
+        if (not self.autofocus_mode) or _converged:
+            num_images = 1
+        else:
+            num_images = self.num_images
 
         # Attempt to capture a set of images.
-        for i in range(self.num_images):
-            self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
+        # These are JPEG encoded in memory, and we keep track of the best (largest) image as we go,
+        # so only that image gets written to disk.
+        largest_pic = None
+        largest_tx_img = None
+        largest_metadata = {}
+        for i in range(num_images):
+            self.debug_message("Capturing Image %d of %d" % (i+1,num_images))
             # Wrap this in error handling in case we lose the camera for some reason.
 
             try:
-                self.cam.capture_file("%s_%d.jpg" % (self.temp_filename_prefix,i))
+                # Grab the main and lores images from the same frame.
+                _request = self.cam.capture_request()
+                try:
+                    _img = _request.make_array("main")
+                    _tx_img = _request.make_array("lores") if self.lores_enabled else None
+                    _metadata = _request.get_metadata()
+                finally:
+                    _request.release()
+
+                _jpeg = simplejpeg.encode_jpeg(_img, quality=quality, colorspace='RGB', fastdct=True)
+                if (largest_pic is None) or (len(_jpeg) > len(largest_pic)):
+                    largest_pic = _jpeg
+                    largest_tx_img = _tx_img
+                    largest_metadata = _metadata
+
                 print(f"Image captured: {time.time()}")
                 if self.image_delay > 0:
                     sleep(self.image_delay)
@@ -252,72 +433,91 @@ class WenetPiCamera2(object):
                 self.debug_message("Capture Error: %s" % str(e))
                 # Immediately return false. Not much point continuing to try and capture images.
                 return False
-        
-        if 'LensPosition' not in self.cam.camera_controls or self.lens_position>=0.0:
-            self.debug_message("Disabling camera.")
-            self.cam.stop()
 
-        # Otherwise, continue to pick the 'best' image based on filesize.
-        self.debug_message("Choosing Best Image.")
-        pic_list = glob.glob("%s_*.jpg" % self.temp_filename_prefix)
-        pic_sizes = []
-        # Iterate through list of images and get the file sizes.
-        for pic in pic_list:
-            pic_sizes.append(os.path.getsize(pic))
-        largest_pic = pic_list[pic_sizes.index(max(pic_sizes))]
-
-        # Copy best image to target filename.
-        self.debug_message("Copying image to storage with filename %s" % filename)
-        os.system("cp %s %s" % (largest_pic, filename))
-        # Clean up temporary images.
-        os.system("rm %s_*.jpg" % self.temp_filename_prefix)
+        # The best image has already been picked, based on filesize.
+        # Write best image to target filename.
+        self.debug_message("Saving image to storage with filename %s" % filename)
+        try:
+            largest_pic = self.add_exif(largest_pic, largest_metadata)
+        except Exception as e:
+            self.debug_message("Could not add EXIF data to image - %s" % str(e))
+        with open(filename, 'wb') as f:
+            f.write(largest_pic)
+
+        # Only the transmit resolution version of the best image needs to be encoded.
+        if tx_filename and (largest_tx_img is not None):
+            self.temp_files.append(tx_filename)
+            with open(tx_filename, 'wb') as f:
+                f.write(self.yuv420_to_jpeg(largest_tx_img, self.tx_resolution, quality=quality))
 
         return True 
 
-    def ssdvify(self, filename="output.jpg", image_id=0, quality=6):
+    def ssdvify(self, filename="output.jpg", image_id=0, quality=6, resize=True):
         """ Convert a supplied JPEG image to SSDV.
-        Returns the filename of the converted SSDV image.
+        Returns the converted SSDV image data (bytes), or None if the conversion failed.
 
         Keyword Arguments:
         filename:	Source JPEG filename.
-                    Output SSDV image will be saved to to a temporary file (webcam_temp.jpg) which should be
-                    transmitted immediately.
         image_id:	Image ID number. Must be incremented between images.
         quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
                     6 provides good quality at decent file-sizes.
+        resize:     Resize the image to the transmit resolution before conversion.
+                    Set to False if the source image is already at the transmit resolution.
+                    Downscaling is partly done during JPEG decode, so is cheaper than upscaling.
 
         """
 
         # Wrap image ID field if it's >255.
         image_id = image_id % 256
 
-        # Resize image to the desired resolution.
-        self.debug_message("Resizing image.")
-        return_code = os.system("timeout -k 5 180 convert %s -scale %dx%d\! picam_temp.jpg" % (filename, self.tx_resolution[0], self.tx_resolution[1]))
-        if return_code != 0:
-            self.debug_message("Resize operation failed! (Possible kernel Oops? Maybe set arm_freq to 700 MHz)")
-            return "FAIL"
-
-        # Get non-extension part of filename.
-        file_basename = filename[:-4]
-
         # Construct SSDV command-line.
-        ssdv_command = "ssdv -e -n -q %d -c %s -i %d picam_temp.jpg picam_temp.ssdv" % (quality, self.callsign, image_id)
-        print(ssdv_command)
+        # No output filename is given, so the SSDV data is written to stdout, which we read straight into memory.
+        ssdv_command = self.ssdv_command_base + ["-q", str(quality), "-i", str(image_id)]
+
+        if resize:
+            # Resize image to the desired resolution.
+            self.debug_message("Resizing image.")
+            # This is done in-process with Pillow (which uses libjpeg-turbo), rather than starting up ImageMagick.
+            # The resized JPEG is kept in memory and piped into ssdv via stdin.
+            # Note that the aspect ratio of the image is not preserved.
+            try:
+                _jpeg = io.BytesIO()
+                with Image.open(filename) as _img:
+                    # When downscaling, let libjpeg-turbo do as much of it as it can during decode (DCT scaling
+                    # by 1/2, 1/4 or 1/8), while staying at or above the transmit resolution.
+                    # This has no effect when upscaling, which is the only case auto_capture() resizes in,
+                    # as downscaling is handled by the camera's lores stream.
+                    _img.draft("RGB", self.tx_resolution)
+                    _img.convert("RGB").resize(self.tx_resolution, Image.BILINEAR).save(_jpeg, format="JPEG", quality=90)
+                ssdv_input = _jpeg.getvalue()
+            except (OSError, ValueError):
+                self.debug_message("Resize operation failed! (Possible kernel Oops? Maybe set arm_freq to 700 MHz)")
+                return None
+        else:
+            # ssdv can read the source image directly.
+            ssdv_command.append(filename)
+            ssdv_input = None
+
+        print(" ".join(ssdv_command))
         # Update debug message.
         self.debug_message("Converting image to SSDV.")
 
         # Run SSDV converter.
-        return_code = os.system(ssdv_command)
-
-        if return_code != 0:
+        try:
+            result = subprocess.run(ssdv_command, input=ssdv_input, stdout=subprocess.PIPE, timeout=180, check=True)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
             self.debug_message("ERROR: Could not perform SSDV Conversion.")
-            return "FAIL"
-        else:
-            return "picam_temp.ssdv"
+            return None
+
+        return result.stdout
 
     auto_capture_running = False
-    def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+    # Sequence number of the current frame, used to give each frame's files unique names.
+    frame_seq = 0
+    # Minimum interval (seconds) between CPU state debug messages.
+    cpu_state_interval = 5.0
+    last_cpu_state_time = 0.0
+    def auto_capture(self, destination_directory, tx, post_process_ptr=None, tx_post_process_ptr=None, delay = 0, start_id = 0):
         """ Automatically capture and transmit images in a loop.
         Images are automatically saved to a supplied directory, with file-names
         defined using a timestamp.
@@ -331,24 +531,86 @@ class WenetPiCamera2(object):
                           will be passed the path/filename of the captured image.
                           This can be used to add overlays, etc to the image before it is SSDVified and transmitted.
                           NOTE: This function need to modify the image in-place.
+        tx_post_process_ptr: An optional function which is called with the path/filename of the transmit
+                          resolution image, if the camera is producing one. This can be used to add overlays
+                          sized for the transmit resolution. If not provided, post_process_ptr is used.
+                          NOTE: This function need to modify the image in-place.
         delay:	An optional delay in seconds between capturing images. Defaults to 0.
-                This delay is added on top of any delays caused while waiting for the transmit queue to empty.
+                This delay starts once the previous image has been pushed into the transmit queue,
+                so it is added on top of any delays caused while waiting for the transmit queue to empty.
         start_id: Starting image ID. Defaults to 0.
         """
 
-        image_id = start_id
+        # Capture and transmission are run as a two-stage pipeline, so the next image can be
+        # captured and converted while the previous image is being transmitted.
+        # The transmitter is the bottleneck, so there's no point getting further ahead of it than that.
+        # The capture worker waits on encoder_ready, which the encode worker sets once it has pushed the
+        # previous image into the transmit queue, so at most one image is ever waiting behind the one on air.
+        # The heavy lifting in both stages (JPEG encoding in simplejpeg, any fallback resize in Pillow,
+        # and the ssdv subprocess) happens outside of the GIL, so the stages can run on separate CPU cores
+        # without needing to use multiprocessing.
+        capture_queue = Queue(maxsize=1)
+        encoder_ready = Event()
+        encoder_ready.set()
+
+        # Remove any temporary images left behind by a previous run.
+        self.cleanup_temp_files()
+
+        encode_thread = Thread(target=self._encode_worker, kwargs=dict(
+            capture_queue=capture_queue,
+            encoder_ready=encoder_ready,
+            tx=tx,
+            start_id=start_id))
+        encode_thread.start()
+
+        self._capture_worker(
+            capture_queue=capture_queue,
+            encoder_ready=encoder_ready,
+            destination_directory=destination_directory,
+            post_process_ptr=post_process_ptr,
+            tx_post_process_ptr=tx_post_process_ptr,
+            delay=delay)
+
+        encode_thread.join()
+
+        # Clean up any temporary images which were still waiting to be converted when we stopped.
+        # We know exactly which files these are, so there's no need to scan the directory again.
+        for _filename in list(self.temp_files):
+            self.remove_temp_file(_filename)
+
+        self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
+
+
+    def _capture_worker(self, capture_queue, encoder_ready, destination_directory, post_process_ptr=None, tx_post_process_ptr=None, delay = 0):
+        """ Capture and post-process images, and pass them onto the encode worker via capture_queue.
+        Refer auto_capture function above.
+        """
+
+        # This is called after the encode worker has been started, so only this thread is affected.
+        self.set_capture_thread_scheduling()
 
         while self.auto_capture_running:
+            # Wait until the previous image has been pushed into the transmit queue.
+            if not encoder_ready.wait(timeout=0.5):
+                continue
+
             # Sleep before capturing next image.
-            sleep(delay)
+            if delay > 0:
+                sleep(delay)
 
             # Grab current timestamp.
-            capture_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
-            capture_filename = destination_directory + "/%s_picam.jpg" % capture_time
+            capture_time = time.strftime("%Y%m%d-%H%M%SZ", time.gmtime())
+            # Each frame's files get unique names, as the previous frame's files may still be in use
+            # by the encode worker, and more than one image can be captured within the same second.
+            capture_filename = os.path.join(destination_directory, f"{capture_time}_{self.frame_seq}_picam.jpg")
+            temp_prefix = "%s_%d" % (self.temp_filename_prefix, self.frame_seq)
+            self.frame_seq += 1
+            # If the camera is producing a transmit resolution stream, that image gets transmitted instead.
+            tx_filename = "%s_tx.jpg" % temp_prefix
 
             # Attempt to capture.
             try:
-                capture_successful = self.capture(capture_filename)
+                capture_successful = self.capture(capture_filename, tx_filename=tx_filename)
             except Exception as e:
                 self.debug_message(f"Exception on capture - {str(e)}")
                 capture_successful = False
@@ -379,6 +641,8 @@ class WenetPiCamera2(object):
                 continue
 
             # Otherwise, proceed to post-processing step.
+            # This is done here rather than in the encode worker so any overlaid data (e.g. GPS position)
+            # matches the time of capture.
             if post_process_ptr != None:
                 try:
                     self.debug_message("Running Image Post-Processing")
@@ -387,44 +651,117 @@ class WenetPiCamera2(object):
                     error_str = traceback.format_exc()
                     self.debug_message("Image Post-Processing Failed: %s" % error_str)
 
+            # If the camera is producing a transmit resolution image, that is what gets sent,
+            # so it needs to be post-processed too.
+            if self.lores_enabled:
+                transmit_filename = tx_filename
+
+                _tx_post_process_ptr = tx_post_process_ptr if tx_post_process_ptr != None else post_process_ptr
+                if _tx_post_process_ptr != None:
+                    try:
+                        self.debug_message("Running Transmit Image Post-Processing")
+                        _tx_post_process_ptr(transmit_filename)
+                    except:
+                        error_str = traceback.format_exc()
+                        self.debug_message("Transmit Image Post-Processing Failed: %s" % error_str)
+            else:
+                transmit_filename = capture_filename
+
+            # Hand the image over to the encode worker.
+            encoder_ready.clear()
+            while self.auto_capture_running:
+                try:
+                    capture_queue.put(transmit_filename, timeout=0.5)
+                    break
+                except Full:
+                    pass
+
+        # Let the encode worker know we are done.
+        try:
+            capture_queue.put_nowait(None)
+        except Full:
+            pass
+
+    def set_capture_thread_scheduling(self):
+        """ Pin the calling thread to the last available CPU core, and move it to the SCHED_BATCH
+            scheduling class, so it doesn't get bounced between cores or preempt the transmit thread.
+            This is best-effort only, and is skipped on single-core systems, or where it is not supported.
+        """
+        try:
+            _cpus = sorted(os.sched_getaffinity(0))
+            if len(_cpus) > 1:
+                os.sched_setaffinity(0, {_cpus[-1]})
+                self.debug_message(f"Pinned capture thread to CPU {_cpus[-1]}")
+
+            os.sched_setscheduler(0, os.SCHED_BATCH, os.sched_param(0))
+        except (AttributeError, OSError) as e:
+            self.debug_message(f"Could not set capture thread scheduling - {str(e)}")
+
+    def _encode_worker(self, capture_queue, encoder_ready, tx, start_id = 0):
+        """ Convert captured images to SSDV, and push them into the transmit queue.
+        Refer auto_capture function above.
+        """
+
+        image_id = start_id
+
+        while self.auto_capture_running:
+            try:
+                transmit_filename = capture_queue.get(timeout=0.5)
+            except Empty:
+                continue
+
+            # Sentinel from the capture worker, indicating it has stopped.
+            if transmit_filename is None:
+                return
+
             # SSDV'ify the image.
-            ssdv_filename = self.ssdvify(capture_filename, image_id=image_id)
+            ssdv_data = self.ssdvify(transmit_filename, image_id=image_id, resize=self.resize_required)
+
+            # Clean up the temporary transmit resolution image.
+            if self.lores_enabled:
+                self.remove_temp_file(transmit_filename)
 
             # Check the SSDV Conversion has completed properly. If not, continue
-            if ssdv_filename == "FAIL":
+            if not ssdv_data:
+                # Let the capture worker try again.
+                encoder_ready.set()
                 sleep(1)
                 continue
 
 
-            # Otherwise, read in the file and push into the TX buffer.
-            file_size = os.path.getsize(ssdv_filename)
+            # Otherwise, push the SSDV data into the TX buffer.
+            file_size = len(ssdv_data)
 
             # Wait until the transmit queue is empty before pushing in packets.
             self.debug_message("Waiting for SSDV TX queue to empty.")
             while tx.image_queue_empty() == False:
-                sleep(0.05) # Sleep for a short amount of time.
+                # Wake up periodically to check if we have been asked to stop.
+                tx.queue_empty_event.wait(timeout=0.5)
                 if self.auto_capture_running == False:
                     return
 
             # Inform ground station we are about to send an image.
             self.debug_message("Transmitting %d PiCam SSDV Packets." % (file_size//256))
 
-            # Push SSDV file into transmit queue.
-            tx.queue_image_file(ssdv_filename)
+            # Push SSDV data into transmit queue.
+            tx.queue_image_bytes(ssdv_data)
+
+            # The next image can now be captured, while this one is being transmitted.
+            encoder_ready.set()
 
             # Increment image ID.
             image_id = (image_id + 1) % 256
 
-            _cpu_temp = self.get_cpu_temperature()
-            _cpu_freq = self.get_cpu_speed()
-            self.debug_message(f"CPU State: Temperature: {_cpu_temp:.1f} degC, Frequency: {_cpu_freq} MHz")
+            # Report CPU state, but not too often.
+            if (time.monotonic() - self.last_cpu_state_time) > self.cpu_state_interval:
+                self.last_cpu_state_time = time.monotonic()
+                _cpu_temp = self.get_cpu_temperature()
+                _cpu_freq = self.get_cpu_speed()
+                self.debug_message(f"CPU State: Temperature: {_cpu_temp:.1f} degC, Frequency: {_cpu_freq} MHz")
 
         # Loop!
 
-        self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
-
-
-    def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+    def run(self, destination_directory, tx, post_process_ptr=None, tx_post_process_ptr=None, delay = 0, start_id = 0):
         """ Start auto-capturing images in a thread.
 
         Refer auto_capture function above.
@@ -436,8 +773,13 @@ class WenetPiCamera2(object):
                           will be passed the path/filename of the captured image.
                           This can be used to add overlays, etc to the image before it is SSDVified and transmitted.
                           NOTE: This function need to modify the image in-place.
+        tx_post_process_ptr: An optional function which is called with the path/filename of the transmit
+                          resolution image, if the camera is producing one. This can be used to add overlays
+                          sized for the transmit resolution. If not provided, post_process_ptr is used.
+                          NOTE: This function need to modify the image in-place.
         delay:	An optional delay in seconds between capturing images. Defaults to 0.
-                This delay is added on top of any delays caused while waiting for the transmit queue to empty.
+                This delay starts once the previous image has been pushed into the transmit queue,
+                so it is added on top of any delays caused while waiting for the transmit queue to empty.
         start_id: Starting image ID. Defaults to 0.
         """		
 
@@ -447,6 +789,7 @@ class WenetPiCamera2(object):
             destination_directory=destination_directory,
             tx = tx,
             post_process_ptr=post_process_ptr,
+            tx_post_process_ptr=tx_post_process_ptr,
             delay=delay,
             start_id=start_id))
 
@@ -463,9 +806,9 @@ class WenetPiCamera2(object):
     def get_cpu_temperature(self):
         """ Grab the temperature of the RPi CPU """
         try:
-            data = subprocess.check_output("/usr/bin/vcgencmd measure_temp", shell=True)
-            temp = data.decode().split('=')[1].split('\'')[0]
-            return float(temp)
+            with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
+                temp = int(f.read().strip())/1000.0
+            return temp
         except Exception as e:
             self.debug_message("Error reading temperature - %s" % str(e))
             return -999
@@ -473,8 +816,8 @@ class WenetPiCamera2(object):
     def get_cpu_speed(self):
         """ Get the current CPU Frequency """
         try:
-            data = subprocess.check_output("cat /sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", shell=True)
-            freq = int(data.decode().strip())/1000
+            with open("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq", "r") as f:
+                freq = int(f.read().strip())/1000
             return freq
         except Exception as e:
             self.debug_message("Error reading CPU Freq - %s" % str(e))
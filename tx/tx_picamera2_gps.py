@@ -33,6 +33,7 @@ parser.add_argument("--hflip", action='store_true', default=False, help="Flip ca
 parser.add_argument("--resize", type=float, default=0.5, help="Resize raw image from camera by this factor before transmit (in both X/Y, to nearest multiple of 16 pixels). Default=0.5")
 parser.add_argument("--whitebalance", type=str, default='daylight', help="White Balance setting: Auto, Daylight, Cloudy, Incandescent, Tungesten, Fluorescent, Indoor")
 parser.add_argument("--lensposition", type=float, default=-1.0, help="For PiCam v3, set the lens position. Default: -1 = Autofocus")
+parser.add_argument("--tx_res_only", action='store_true', default=False, help="Capture and save images at the transmit resolution only, rather than at full resolution.")
 parser.add_argument("-v", "--verbose", action='store_true', default=False, help="Show additional debug info.")
 args = parser.parse_args()
 
@@ -141,8 +142,13 @@ except Exception as e:
 
 # Define our post-processing callback function, which gets called by WenetPiCam
 # after an image has been captured.
-def post_process_image(filename):
-	""" Post-process the image, adding on Logo overlay and GPS data if requested. """
+def post_process_image(filename, scale=1.0, add_exif=True):
+	""" Post-process the image, adding on Logo overlay and GPS data if requested.
+
+	Keyword Arguments:
+	scale: Size of this image relative to the full resolution image, used to scale the overlays to suit.
+	add_exif: Add the GPS position to the image's EXIF data.
+	"""
 	global gps, max_altitude, args, tx
 
 	# Try and grab current GPS data snapshot
@@ -168,11 +174,12 @@ def post_process_image(filename):
 					int(max_altitude),
 					gps_state['ground_speed'],
 					gps_state['ascent_rate'])
-				gps_exif_commmand = "exiftool -GPSLatitude*=%.5f -GPSLongitude*=%.5f -GPSAltitude*=%d " % (
-					gps_state['latitude'],
-					gps_state['longitude'],
-					int(gps_state['altitude'])
-				)
+				if add_exif:
+					gps_exif_commmand = "exiftool -GPSLatitude*=%.5f -GPSLongitude*=%.5f -GPSAltitude*=%d " % (
+						gps_state['latitude'],
+						gps_state['longitude'],
+						int(gps_state['altitude'])
+					)
 		else:
 			gps_string = ""
 	except:
@@ -181,12 +188,15 @@ def post_process_image(filename):
 		gps_string = ""
 
 	# Build up our imagemagick 'convert' command line
-	overlay_str = "timeout -k 5 180 convert %s -gamma 0.8 -font Helvetica -pointsize 40 -gravity North " % filename 
+	overlay_str = "timeout -k 5 180 convert %s -gamma 0.8 -font Helvetica -pointsize %d -gravity North " % (filename, int(40*scale))
 	overlay_str += "-strokewidth 2 -stroke '#000C' -annotate +0+5 \"%s\" " % gps_string
 	overlay_str += "-stroke none -fill white -annotate +0+5 \"%s\" " % gps_string
 	# Add on logo overlay argument if we have been given one.
 	if args.logo != "none":
-		overlay_str += "%s -gravity SouthEast -composite " % args.logo
+		if scale != 1.0:
+			overlay_str += "\\( %s -resize %d%% \\) -gravity SouthEast -composite " % (args.logo, int(100*scale))
+		else:
+			overlay_str += "%s -gravity SouthEast -composite " % args.logo
 
 	overlay_str += filename
 
@@ -204,6 +214,17 @@ def post_process_image(filename):
 	return
 
 
+def post_process_tx_image(filename):
+	""" Post-process the transmit resolution image, with overlays scaled to match the full resolution image.
+	EXIF data is not transmitted via SSDV, so it is not added here. """
+	post_process_image(filename, scale=args.resize, add_exif=False)
+
+
+def post_process_tx_res_only_image(filename):
+	""" Post-process an image captured directly at the transmit resolution (--tx_res_only). """
+	post_process_image(filename, scale=args.resize)
+
+
 # Finally, initialise the PiCam capture object.
 picam = WenetPiCamera2.WenetPiCamera2( 
 		tx_resolution=args.resize,
@@ -213,11 +234,13 @@ picam = WenetPiCamera2.WenetPiCamera2(
 		vertical_flip=args.vflip, 
 		horizontal_flip=args.hflip,
 		whitebalance=args.whitebalance,
-		lens_position=args.lensposition)
+		lens_position=args.lensposition,
+		save_full_resolution=not args.tx_res_only)
 # .. and start it capturing continuously.
 picam.run(destination_directory="./tx_images/", 
 	tx = tx,
-	post_process_ptr = post_process_image
+	post_process_ptr = post_process_tx_res_only_image if args.tx_res_only else post_process_image,
+	tx_post_process_ptr = post_process_tx_image
 	)
 
 